@@ -4,10 +4,29 @@ Auto-classifies emails (ignore/process) and creates draft replies
 """
 
 import os
+import sys
+import platform
 import time
 import re
-from typing import List, Dict, Any, Optional
+import json
+import asyncio
+import binascii
+import hashlib
+import sqlite3
+import threading
+import logging
+import logging.handlers
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, Tuple
 from dotenv import load_dotenv
+import httplib2
+import httpx
+import faiss
+import numpy as np
+import torch
+from pybloom_live import ScalableBloomFilter
 
 # Patch for langchain-google-community bug
 import google.oauth2.service_account
@@ -17,17 +36,612 @@ if not hasattr(google.oauth2.service_account, 'ServiceCredentials'):
 from langchain_groq import ChatGroq
 from langchain_google_community import GmailToolkit
 from langchain_google_community.gmail.utils import build_gmail_service, get_google_credentials
+from google.auth.transport.requests import Request
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.errors import HttpError
 from langgraph.prebuilt import create_react_agent
 from langmem import create_manage_memory_tool, create_search_memory_tool
+from langgraph.store.base import SearchItem, SearchOp
 from langgraph.store.memory import InMemoryStore
 from langchain_huggingface import HuggingFaceEmbeddings
+from langchain_core.callbacks import BaseCallbackHandler
 
 
+# Per-email progress is buffered and written once per sweep (or every 200 lines)
+logger = logging.getLogger('email_agent')
+logger.setLevel(logging.INFO)
+logger.propagate = False
+log_handler = logging.handlers.MemoryHandler(capacity=200, target=logging.StreamHandler(sys.stdout))
+log_handler.target.setFormatter(logging.Formatter("%(message)s"))
+logger.addHandler(log_handler)
+
+# Gmail accepts at most 100 calls per batch request
+GMAIL_BATCH_LIMIT = 100
+# Single GETs go straight to the REST API over one shared HTTP/2 connection pool
+GMAIL_API_URL = "https://gmail.googleapis.com/gmail/v1/users/me"
+GMAIL_MAX_CONNECTIONS = 20
+# Fallback when the batch endpoint fails: concurrent REST GETs
+FALLBACK_CONCURRENCY = 20
+
+# Processed email IDs survive restarts in this sqlite file
+PROCESSED_DB_PATH = "processed.db"
+
+# Matches the bare address inside headers like "Name <user@example.com>"
+_EMAIL_RE = re.compile(r'[\w\.-]+@[\w\.-]+')
+# Conversation history per sender is reused for this many seconds (and cleared every sweep)
+HISTORY_CACHE_TTL = 300
+
+
+def _headers_dict(payload: Dict[str, Any]) -> Dict[str, str]:
+    """Map lowercased header names to values in one pass (first occurrence wins)"""
+    return {h['name'].lower(): h['value'] for h in reversed(payload.get('headers', []))}
+
+
+def _email_summary(msg_id: str, msg_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Build the email summary used by the processing loop from metadata-format data"""
+    headers = _headers_dict(msg_data.get('payload', {}))
+    return {
+        'id': msg_id,
+        'sender': headers.get('from', 'Unknown'),
+        'subject': headers.get('subject', 'No Subject'),
+        'date': headers.get('date', 'Unknown'),
+        'internal_date': int(msg_data.get('internalDate', 0)),
+        'list_unsubscribe': headers.get('list-unsubscribe', ''),
+        'label_ids': msg_data.get('labelIds', [])
+    }
+
+
+# Gmail bodies are URL-safe base64; binascii only speaks the standard alphabet
+_URLSAFE_TO_STD_B64 = bytes.maketrans(b'-_', b'+/')
+
+
+def _walk_parts(part: Dict[str, Any]):
+    """Yield the body of every text/plain part, depth-first (handles nested multipart)"""
+    if part.get('mimeType') == 'text/plain' and part.get('body', {}).get('data'):
+        yield part['body']
+    for child in part.get('parts', ()):
+        yield from _walk_parts(child)
+
+
+def _decode_body(body: Dict[str, Any], max_bytes: int) -> str:
+    """Decode at most max_bytes of Gmail's URL-safe base64 body data (padding may be missing)"""
+    data = body.get('data', '')
+    if not data or body.get('size') == 0:
+        return ""
+    # Every 4 base64 chars hold 3 bytes: cut on a 4-char boundary and skip the tail
+    data = data[:max_bytes // 3 * 4]
+    raw = data.encode('ascii').translate(_URLSAFE_TO_STD_B64)
+    return binascii.a2b_base64(raw + b'=' * (-len(raw) % 4)).decode('utf-8', errors='ignore')
+
+
+# Reuse a past classification when a new email embeds at least this close to it
+CLASSIFICATION_CACHE_THRESHOLD = 0.9
+CLASSIFICATION_CACHE_TTL = 7 * 24 * 60 * 60  # seconds
+CLASSIFICATION_LABELS = ("ignore", "process")
+
+CLASSIFICATION_RULES = """**Ignore** emails that are:
+* Promotional or marketing (sales, offers, discounts, newsletters)
+* Automated system emails (confirmations, subscriptions, security alerts)
+* Social notifications (LinkedIn, Instagram, YouTube, etc.)
+* Event updates, ticket bookings, or receipts
+* Recruitment spam, newsletters, or general HR ads
+* Mails without a personal greeting or request for action
+* Gaming promotions, rewards, or virtual currency offers
+* No-reply senders with marketing content
+
+**Process** emails that are:
+* From known colleagues, professors, or managers
+* Contain questions, requests, or project details
+* Related to academic or professional tasks
+* Require replies, reports, scheduling, or document review
+* Have "urgent", "follow-up", or "update" in subject
+* Personal correspondence with specific requests
+"""
+
+# Short emails from personal-looking senders are classified and drafted in one LLM call
+FUSED_MAX_BODY_CHARS = 500
+AUTOMATED_SENDER_HINTS = ("no-reply", "noreply", "donotreply", "do-not-reply", "notifications@", "newsletter", "unsubscribe", "mailer-daemon")
+# Gmail tabs whose emails are never worth an LLM call
+IGNORED_CATEGORY_LABELS = ("CATEGORY_PROMOTIONS", "CATEGORY_SOCIAL")
+# Anything in these tabs is outside 'category:primary'
+NON_PRIMARY_CATEGORY_LABELS = ("CATEGORY_PROMOTIONS", "CATEGORY_SOCIAL", "CATEGORY_UPDATES", "CATEGORY_FORUMS")
+
+
+def _looks_automated(sender: str) -> bool:
+    """Check if a From header looks like a bulk/automated sender"""
+    sender = sender.lower()
+    return any(hint in sender for hint in AUTOMATED_SENDER_HINTS)
+
+
+def _prefilter_ignore(email: Dict[str, Any]) -> bool:
+    """Cheap rule-based check for emails that can be ignored without the LLM"""
+    if _looks_automated(email.get('from') or email.get('sender', '')):
+        return True
+    if email.get('list_unsubscribe'):
+        return True
+    return any(label in IGNORED_CATEGORY_LABELS for label in email.get('label_ids', []))
+
+
+# Groq rate limit shared by every LLM request the agent makes (a ReAct task makes several)
+LLM_REQUESTS_PER_MINUTE = 30
+LLM_BURST = 5  # Requests allowed back to back before the refill rate applies
+
+
+class TokenBucket:
+    """Thread-safe token bucket: bursts up to capacity, then refills at rate tokens/second"""
+    
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def acquire(self):
+        """Take one token, sleeping only as long as it takes to refill"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            # Reserve the token now (may go negative) so concurrent callers queue fairly
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class RateLimitCallback(BaseCallbackHandler):
+    """Takes a TokenBucket token before every chat model request"""
+    
+    def __init__(self, bucket: TokenBucket):
+        self.bucket = bucket
+    
+    def on_chat_model_start(self, serialized, messages, **kwargs):
+        self.bucket.acquire()
+
+
+class ClassificationCache:
+    """Semantic cache of email classifications (FAISS inner-product index per mailbox)"""
+    
+    def __init__(self, embeddings, dims: int, threshold: float = CLASSIFICATION_CACHE_THRESHOLD, ttl: float = CLASSIFICATION_CACHE_TTL):
+        self.embeddings = embeddings
+        self.dims = dims
+        self.threshold = threshold
+        self.ttl = ttl
+        self._mailboxes: Dict[str, Dict[str, Any]] = {}
+    
+    def _new_index(self):
+        """Inner-product index storing vectors as fp16 (half the memory of IndexFlatIP)"""
+        return faiss.IndexScalarQuantizer(self.dims, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_INNER_PRODUCT)
+    
+    def _entries(self, mailbox: str) -> Dict[str, Any]:
+        """Get (or create) the index and parallel label lists for a mailbox"""
+        if mailbox not in self._mailboxes:
+            self._mailboxes[mailbox] = {
+                'index': self._new_index(),
+                'vectors': [],
+                'labels': [],
+                'added_at': [],
+            }
+        return self._mailboxes[mailbox]
+    
+    def embed(self, text: str) -> np.ndarray:
+        """Embed text as an L2-normalized row vector (inner product == cosine)"""
+        vector = np.array([self.embeddings.embed_query(text)], dtype=np.float32)
+        faiss.normalize_L2(vector)
+        return vector
+    
+    def lookup(self, mailbox: str, vector: np.ndarray) -> Optional[str]:
+        """Return the cached label of the nearest email, if similar enough and not expired"""
+        entries = self._entries(mailbox)
+        if entries['index'].ntotal == 0:
+            return None
+        
+        scores, ids = entries['index'].search(vector, 1)
+        idx = int(ids[0][0])
+        if idx < 0 or scores[0][0] < self.threshold:
+            return None
+        
+        if time.time() - entries['added_at'][idx] > self.ttl:
+            self._evict_expired(entries)
+            return self.lookup(mailbox, vector)
+        
+        return entries['labels'][idx]
+    
+    def add(self, mailbox: str, vector: np.ndarray, label: str):
+        """Remember the label for an embedded email"""
+        entries = self._entries(mailbox)
+        entries['index'].add(vector)
+        entries['vectors'].append(vector[0].astype(np.float16))
+        entries['labels'].append(label)
+        entries['added_at'].append(time.time())
+    
+    def _evict_expired(self, entries: Dict[str, Any]):
+        """Drop entries older than the TTL and rebuild the index"""
+        now = time.time()
+        keep = [i for i, added_at in enumerate(entries['added_at']) if now - added_at <= self.ttl]
+        
+        entries['vectors'] = [entries['vectors'][i] for i in keep]
+        entries['labels'] = [entries['labels'][i] for i in keep]
+        entries['added_at'] = [entries['added_at'][i] for i in keep]
+        entries['index'] = self._new_index()
+        if keep:
+            entries['index'].add(np.vstack(entries['vectors']).astype(np.float32))
+
+
+class CachedEmbeddings(HuggingFaceEmbeddings):
+    """HuggingFace embeddings with an LRU cache (SHA1 of model + text), persisted to sqlite"""
+    
+    cache_path: str = "embeddings.db"
+    max_cache_entries: int = 10_000
+    
+    def __init__(self, **kwargs: Any):
+        super().__init__(**kwargs)
+        self._cache: OrderedDict[str, List[float]] = OrderedDict()
+        # Store tools and query embedding may run on worker threads
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.cache_path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB)")
+        self._db.commit()
+    
+    def _key(self, text: str) -> str:
+        """Cache key; includes the model so switching models never returns stale vectors"""
+        return hashlib.sha1(f"{self.model_name}\n{text}".encode()).hexdigest()
+    
+    def _remember(self, key: str, vector: List[float]):
+        """Insert into the in-memory LRU, evicting the oldest entry on overflow"""
+        self._cache[key] = vector
+        self._cache.move_to_end(key)
+        if len(self._cache) > self.max_cache_entries:
+            self._cache.popitem(last=False)
+    
+    def _lookup(self, key: str) -> Optional[List[float]]:
+        """Find a cached vector in memory, then on disk (caller holds the lock)"""
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        
+        row = self._db.execute("SELECT vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        vector = np.frombuffer(row[0], dtype=np.float16).astype(np.float32).tolist()
+        self._remember(key, vector)
+        return vector
+    
+    def _save(self, keys: List[str], vectors: List[List[float]]):
+        """Cache new vectors in memory and on disk (as float16 blobs)"""
+        with self._lock:
+            for key, vector in zip(keys, vectors):
+                self._remember(key, vector)
+            self._db.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                [(key, np.asarray(vector, dtype=np.float16).tobytes()) for key, vector in zip(keys, vectors)]
+            )
+            self._db.commit()
+    
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """Embed documents, running the model only on cache misses"""
+        keys = [self._key(text) for text in texts]
+        with self._lock:
+            vectors = [self._lookup(key) for key in keys]
+        
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            with torch.inference_mode():
+                computed = super().embed_documents([texts[i] for i in missing])
+            self._save([keys[i] for i in missing], computed)
+            for i, vector in zip(missing, computed):
+                vectors[i] = vector
+        
+        return vectors
+    
+    def embed_query(self, text: str) -> List[float]:
+        """Embed a query, running the model only on a cache miss"""
+        key = self._key(text)
+        with self._lock:
+            vector = self._lookup(key)
+        
+        if vector is None:
+            with torch.inference_mode():
+                vector = super().embed_query(text)
+            self._save([key], [vector])
+        
+        return vector
+
+
+def quantize_int8(vector) -> Tuple[np.ndarray, float]:
+    """Symmetric int8 quantization with a per-vector scale (vector ≈ codes * scale)"""
+    values = np.asarray(vector, dtype=np.float32)
+    scale = float(np.abs(values).max()) / 127 or 1.0
+    codes = np.round(values / scale).astype(np.int8)
+    return codes, scale
+
+
+# Memory search switches from an exact scan to an HNSW index past this many vectors
+HNSW_MIN_VECTORS = 1000
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 128  # Floor for the search beam; faiss' default of 16 misses half the true top-10
+HNSW_OVERSAMPLE = 4  # ANN candidates fetched per requested result, reranked exactly
+# The index is rebuilt lazily after this many inserts or this many seconds (if anything changed)
+HNSW_REBUILD_INSERTS = 1000
+HNSW_REBUILD_INTERVAL = 300
+# Initial row count of the embedding matrix; it doubles whenever it fills up with live rows
+VECTOR_MATRIX_ROWS = 1024
+
+
+class QuantizedStore(InMemoryStore):
+    """InMemoryStore that keeps memory embeddings as int8 codes (4x less RAM than float32)"""
+    
+    def __init__(self, *, index=None):
+        super().__init__(index=index)
+        # Puts made inside deferred_embeddings() are embedded in one batch on exit
+        self._defer_depth = 0
+        self._pending_embed = []
+        self._pending_lock = threading.Lock()
+        # HNSW index over all vectors; rows map to (namespace, key, path) via _hnsw_locations
+        self._hnsw = None
+        self._hnsw_locations = []
+        self._hnsw_built_at = 0.0
+        self._hnsw_lock = threading.Lock()
+        self._unindexed = set()  # Locations written since the last build
+        # Embeddings are rows of one contiguous int8 matrix with parallel scale/norm arrays;
+        # _vectors[namespace][key][path] holds the row number
+        dims = self.index_config["dims"] if self.index_config else 0
+        self._codes = np.empty((VECTOR_MATRIX_ROWS, dims), dtype=np.int8)
+        self._scales = np.empty(VECTOR_MATRIX_ROWS, dtype=np.float32)
+        self._norms = np.empty(VECTOR_MATRIX_ROWS, dtype=np.float32)
+        self._rows = 0
+        self._matrix_lock = threading.RLock()  # Row numbers change when the matrix is compacted
+    
+    @contextmanager
+    def deferred_embeddings(self):
+        """Queue embeddings for put() calls and embed them with one embed_documents call on exit"""
+        self._defer_depth += 1
+        try:
+            yield
+        finally:
+            self._defer_depth -= 1
+            if not self._defer_depth:
+                self.flush_pending_embeddings()
+    
+    def flush_pending_embeddings(self):
+        """Embed all queued texts as a single batch and index the resulting vectors"""
+        with self._pending_lock:
+            pending, self._pending_embed = self._pending_embed, []
+        if not pending or not self.embeddings:
+            return
+        
+        # Latest text per (namespace, key, path) wins; skip items deleted since
+        latest = {}
+        for to_embed in pending:
+            for text, locations in to_embed.items():
+                for namespace, key, path in locations:
+                    latest[(namespace, key, path)] = text
+        grouped = defaultdict(list)
+        for (namespace, key, path), text in latest.items():
+            if key in self._data.get(namespace, {}):
+                grouped[text].append((namespace, key, path))
+        
+        if grouped:
+            vectors = self.embeddings.embed_documents(list(grouped))
+            self._insertinmem_store(grouped, vectors)
+    
+    def batch(self, ops):
+        ops = list(ops)
+        with self._matrix_lock:
+            # Searches must see every queued memory, so they flush first
+            if not self._defer_depth or any(isinstance(op, SearchOp) for op in ops):
+                self.flush_pending_embeddings()
+                return super().batch(ops)
+            
+            results, put_ops, _ = self._prepare_ops(ops)
+            to_embed = self._extract_texts(put_ops)
+            if to_embed:
+                with self._pending_lock:
+                    self._pending_embed.append(to_embed)
+            self._apply_put_ops(put_ops)
+            return results
+    
+    async def abatch(self, ops):
+        # Row numbers captured while filtering must stay valid until scoring, so async
+        # calls take the same locked path as batch() on a worker thread
+        return await asyncio.to_thread(self.batch, list(ops))
+    
+    def _reserve_rows(self, count):
+        """Make room for count more rows, dropping dead rows and doubling the matrix when full"""
+        if self._rows + count <= len(self._codes):
+            return
+        
+        # Rows of overwritten or deleted vectors are no longer referenced from _vectors
+        remap = {}
+        for keys in self._vectors.values():
+            for paths in keys.values():
+                for path, row in paths.items():
+                    paths[path] = remap.setdefault(row, len(remap))
+        
+        capacity = len(self._codes)
+        while capacity < 2 * (len(remap) + count):
+            capacity *= 2
+        live = np.fromiter(remap, dtype=np.int64, count=len(remap))
+        codes = np.empty((capacity, self._codes.shape[1]), dtype=np.int8)
+        scales = np.empty(capacity, dtype=np.float32)
+        norms = np.empty(capacity, dtype=np.float32)
+        codes[:len(live)] = self._codes[live]
+        scales[:len(live)] = self._scales[live]
+        norms[:len(live)] = self._norms[live]
+        self._codes, self._scales, self._norms, self._rows = codes, scales, norms, len(live)
+    
+    def _insertinmem_store(self, to_embed, embeddings):
+        """Quantize embeddings into new matrix rows ([namespace][key][path] -> row)"""
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        if not len(vectors):
+            return
+        scales = np.abs(vectors).max(axis=1) / 127
+        scales[scales == 0] = 1.0
+        norms = np.linalg.norm(vectors, axis=1)
+        norms[norms == 0] = 1.0
+        
+        with self._matrix_lock:
+            self._reserve_rows(len(vectors))
+            start = self._rows
+            end = start + len(vectors)
+            self._codes[start:end] = np.round(vectors / scales[:, None]).astype(np.int8)
+            self._scales[start:end] = scales
+            self._norms[start:end] = norms
+            self._rows = end
+            
+            for row, locations in enumerate(to_embed.values(), start):
+                for namespace, key, path in locations:
+                    self._vectors[namespace][key][path] = row
+                    with self._hnsw_lock:
+                        self._unindexed.add((namespace, key, path))
+    
+    def _rebuild_hnsw(self):
+        """Rebuild the HNSW index from the current vectors (caller holds both locks)"""
+        self._hnsw_built_at = time.time()
+        self._unindexed = set()
+        locations, rows = [], []
+        for namespace, keys in self._vectors.items():
+            for key, paths in keys.items():
+                for path, row in paths.items():
+                    locations.append((namespace, key, path))
+                    rows.append(row)
+        if len(rows) < HNSW_MIN_VECTORS:
+            self._hnsw, self._hnsw_locations = None, []
+            return
+        
+        # Per-vector scales cancel out once rows are normalized
+        matrix = self._codes[rows].astype(np.float32)
+        faiss.normalize_L2(matrix)
+        index = faiss.IndexHNSWFlat(matrix.shape[1], HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        index.add(matrix)
+        self._hnsw, self._hnsw_locations = index, locations
+    
+    def _ann_candidates(self, op, query_vector, candidates):
+        """Narrow search candidates to HNSW hits plus not-yet-indexed vectors"""
+        with self._hnsw_lock:
+            changed = len(self._unindexed)
+            if changed >= HNSW_REBUILD_INSERTS or (
+                changed and (self._hnsw is None or time.time() - self._hnsw_built_at >= HNSW_REBUILD_INTERVAL)
+            ):
+                self._rebuild_hnsw()
+            index, locations = self._hnsw, self._hnsw_locations
+            hit_keys = {(namespace, key) for namespace, key, _ in self._unindexed}
+        
+        if index is None:
+            return candidates
+        
+        wanted = op.offset + op.limit
+        query = np.array([query_vector], dtype=np.float32)
+        faiss.normalize_L2(query)
+        k = min(index.ntotal, wanted * HNSW_OVERSAMPLE)
+        params = faiss.SearchParametersHNSW(efSearch=max(HNSW_EF_SEARCH, k))
+        _, ids = index.search(query, k, params=params)
+        hit_keys.update(locations[i][:2] for i in ids[0] if i >= 0)
+        
+        narrowed = [
+            (item, vectors) for item, vectors in candidates
+            if not vectors or (item.namespace, item.key) in hit_keys
+        ]
+        # Filters can exclude most ANN hits; fall back to the exact scan then
+        if sum(1 for _, vectors in narrowed if vectors) < wanted:
+            return candidates
+        return narrowed
+    
+    def _batch_search(self, ops, queryinmem_store, results):
+        """Rank candidates by cosine similarity computed from int8 dot products"""
+        with self._matrix_lock:
+            self._search_matrix(ops, queryinmem_store, results)
+    
+    def _search_matrix(self, ops, queryinmem_store, results):
+        """Score search ops against the embedding matrix (caller holds the matrix lock)"""
+        unscored_ops = {}
+        
+        for i, (op, candidates) in ops.items():
+            if not (candidates and op.query and queryinmem_store):
+                unscored_ops[i] = (op, candidates)
+                continue
+            
+            query_codes, query_scale = quantize_int8(queryinmem_store[op.query])
+            query_norm = float(np.linalg.norm(queryinmem_store[op.query])) or 1.0
+            candidates = self._ann_candidates(op, queryinmem_store[op.query], candidates)
+            
+            flat_items, flat_rows = [], []
+            scoreless = []
+            for item, vectors in candidates:
+                for row in vectors:
+                    flat_items.append(item)
+                    flat_rows.append(row)
+                if not vectors:
+                    scoreless.append(item)
+            
+            scores = []
+            if flat_items:
+                rows = np.array(flat_rows, dtype=np.int64)
+                # Scan the whole contiguous block unless ANN/filters left only a small subset
+                if 2 * len(rows) >= self._rows:
+                    dots = np.einsum('ij,j->i', self._codes[:self._rows], query_codes, dtype=np.int32)[rows]
+                else:
+                    dots = np.einsum('ij,j->i', self._codes[rows], query_codes, dtype=np.int32)
+                scores = dots * (self._scales[rows] * (query_scale / query_norm) / self._norms[rows])
+            
+            # Max pooling over each item's vectors, then apply offset/limit
+            ranked = sorted(zip(scores, range(len(flat_items))), key=lambda x: x[0], reverse=True)
+            seen = set()
+            kept = []
+            for score, idx in ranked:
+                item = flat_items[idx]
+                if (item.namespace, item.key) in seen:
+                    continue
+                position = len(seen)
+                seen.add((item.namespace, item.key))
+                if position >= op.offset + op.limit:
+                    break
+                if position >= op.offset:
+                    kept.append((float(score), item))
+            
+            # Fill with unembedded items if there are not enough scored ones
+            if scoreless and len(kept) < op.limit:
+                kept.extend((None, item) for item in scoreless[:op.limit - len(kept)])
+            
+            results[i] = [
+                SearchItem(
+                    namespace=item.namespace,
+                    key=item.key,
+                    value=item.value,
+                    created_at=item.created_at,
+                    updated_at=item.updated_at,
+                    score=score,
+                )
+                for score, item in kept
+            ]
+        
+        if unscored_ops:
+            super()._batch_search(unscored_ops, queryinmem_store, results)
+
 
 # Using Langmem for memory capabilities
 # Defining embedding model and storage for memory
-embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-mpnet-base-v2")
-store = InMemoryStore(index={"dims": 768, "embed": embeddings})
+# MiniLM (384-d) is ~5x faster to encode than mpnet and good enough for memory/cache lookups
+EMBEDDING_DIMS = 384
+# EMBEDDING_BACKEND=torch runs PyTorch in bfloat16 instead of ONNX Runtime
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "onnx")
+if EMBEDDING_BACKEND == "torch":
+    embedding_model_kwargs = {"model_kwargs": {"torch_dtype": torch.bfloat16}}
+    if platform.machine().lower() in ("x86_64", "amd64"):
+        torch.set_num_threads(os.cpu_count())
+        torch.backends.mkldnn.enabled = True  # oneDNN bf16 GEMMs
+else:
+    embedding_model_kwargs = {"backend": "onnx"}
+embeddings = CachedEmbeddings(
+    model_name="sentence-transformers/all-MiniLM-L6-v2",
+    model_kwargs=embedding_model_kwargs,
+    encode_kwargs={"batch_size": 32, "normalize_embeddings": True},
+)
+store = QuantizedStore(index={"dims": EMBEDDING_DIMS, "embed": embeddings})
+classification_cache = ClassificationCache(embeddings, EMBEDDING_DIMS)
 
 
 # Load API keys
@@ -48,6 +662,22 @@ class EmailAgent:
         )
         self.api_resource = build_gmail_service(credentials=self.credentials)
         
+        # httplib2 (used for batch requests) is not thread-safe: each thread gets its own connection
+        self._local = threading.local()
+        
+        # All other Gmail reads share one HTTP/2 client, driven by a background event loop
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, daemon=True).start()
+        self._gmail_client = httpx.AsyncClient(
+            http2=True,
+            base_url=GMAIL_API_URL,
+            limits=httpx.Limits(max_connections=GMAIL_MAX_CONNECTIONS),
+        )
+        self._refresh_lock = asyncio.Lock()  # Concurrent requests share one token refresh
+        
+        # Mailbox address namespaces the classification cache
+        self.mailbox = self._gmail_get("/profile")['emailAddress']
+        
         # Gmail tools
         toolkit = GmailToolkit(api_resource=self.api_resource)
         gmail_tools = toolkit.get_tools()
@@ -60,8 +690,14 @@ class EmailAgent:
         # Combine all tools
         self.tools = gmail_tools + memory_tools
         
-        # LLM setup
-        self.llm = ChatGroq(model="openai/gpt-oss-120b", streaming=True)
+        # LLM setup (rate limited per model request, including each ReAct step)
+        self._bucket = TokenBucket(rate=LLM_REQUESTS_PER_MINUTE / 60.0, capacity=LLM_BURST)
+        rate_limit = RateLimitCallback(self._bucket)
+        self.llm = ChatGroq(model="openai/gpt-oss-120b", streaming=True, callbacks=[rate_limit])
+        # Groq's JSON mode does not support streaming, so the fused call uses its own client
+        self.json_llm = ChatGroq(model="openai/gpt-oss-120b", streaming=False, callbacks=[rate_limit]).bind(
+            response_format={"type": "json_object"}
+        )
         
         # Create agent
         self.agent_executor = create_react_agent(
@@ -70,39 +706,168 @@ class EmailAgent:
             store=store,
         )
         
-        # Tracking
-        self.processed_emails = set()
+        # Gmail historyId checkpoint for incremental sync (set after the first run)
+        self.history_id = None
+        
+        # Conversation history per sender: address -> (fetched_at, result)
+        self._history_cache: Dict[str, Tuple[float, Dict]] = {}
+        self._history_locks = defaultdict(threading.Lock)  # One fetch per sender at a time
+        self._history_lock = threading.Lock()
+        
+        # Tracking: sqlite log of processed IDs, fronted by a bloom filter for cheap misses
+        self._db = sqlite3.connect(PROCESSED_DB_PATH)
+        self._db.execute("CREATE TABLE IF NOT EXISTS processed (id TEXT PRIMARY KEY, ts INTEGER)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS processed_ts ON processed (ts)")
+        self._db.commit()
+        self._bloom = ScalableBloomFilter(initial_capacity=10_000, error_rate=1e-4)
+        for (msg_id,) in self._db.execute("SELECT id FROM processed"):
+            self._bloom.add(msg_id)
         self.last_check_time = None  # Keep for backward compatibility
-        self.last_processed_id = None  # NEW: Track by email ID instead of timestamp
         
         print("✓ Agent ready! Memory-augmented classification enabled.")
     
+    def _http(self) -> AuthorizedHttp:
+        """Authorized HTTP client for the current thread"""
+        if not hasattr(self._local, 'http'):
+            self._local.http = AuthorizedHttp(self.credentials, http=httplib2.Http())
+        return self._local.http
+    
+    def _run(self, coro):
+        """Run a coroutine on the background event loop and wait for the result"""
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+    
+    async def _auth_headers(self, rejected_token: Optional[str] = None) -> Dict[str, str]:
+        """Bearer token header, refreshing the OAuth token off the event loop when expired (or rejected)"""
+        def stale():
+            return not self.credentials.valid or self.credentials.token == rejected_token
+        
+        if stale():
+            async with self._refresh_lock:
+                # Another request may have refreshed while this one waited
+                if stale():
+                    await asyncio.to_thread(self.credentials.refresh, Request())
+        return {"Authorization": f"Bearer {self.credentials.token}"}
+    
+    async def _gmail_get_async(self, path: str, params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """GET a Gmail REST resource, retrying once with a fresh token on 401"""
+        headers = await self._auth_headers()
+        response = await self._gmail_client.get(path, params=params, headers=headers)
+        if response.status_code == 401:
+            headers = await self._auth_headers(rejected_token=headers["Authorization"].split(" ", 1)[1])
+            response = await self._gmail_client.get(path, params=params, headers=headers)
+        response.raise_for_status()
+        return response.json()
+    
+    def _gmail_get(self, path: str, params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """GET a Gmail REST resource (relative to users/me) over the shared client"""
+        return self._run(self._gmail_get_async(path, params))
+    
+    @property
+    def last_processed_id(self) -> Optional[str]:
+        """ID of the newest processed email (by Gmail internal date)"""
+        row = self._db.execute("SELECT id FROM processed ORDER BY ts DESC LIMIT 1").fetchone()
+        return row[0] if row else None
+    
+    def is_processed(self, message_id: str) -> bool:
+        """Check if an email was already handled (bloom filter first, sqlite confirms)"""
+        if message_id not in self._bloom:
+            return False
+        return self._db.execute("SELECT 1 FROM processed WHERE id = ?", (message_id,)).fetchone() is not None
+    
+    def mark_processed(self, message_id: str, internal_date: Optional[int] = None):
+        """Record an email as handled"""
+        self._bloom.add(message_id)
+        self._db.execute(
+            "INSERT OR IGNORE INTO processed (id, ts) VALUES (?, ?)",
+            (message_id, internal_date or int(time.time() * 1000))
+        )
+        self._db.commit()
+    
     def run_agent_task(self, query: str) -> str:
         """Execute agent task"""
         try:
-            events = self.agent_executor.stream(
+            # "updates" streams only each node's new messages; only the last one matters
+            last_update = None
+            for update in self.agent_executor.stream(
                 {"messages": [("user", query)]},
-                stream_mode="values",
-            )
-            
-            all_messages = []
-            for event in events:
-                all_messages.append(event["messages"][-1])
+                stream_mode="updates",
+            ):
+                last_update = update
             
-            if all_messages:
-                final_message = all_messages[-1]
-                if hasattr(final_message, 'content'):
-                    return final_message.content
-                return str(final_message)
+            if last_update:
+                node_output = next(iter(last_update.values())) or {}
+                messages = node_output.get("messages", [])
+                if messages:
+                    final_message = messages[-1]
+                    if hasattr(final_message, 'content'):
+                        return final_message.content
+                    return str(final_message)
             
             return "No response"
         except Exception as e:
-            print(f"Error: {e}")
+            logger.warning("Error: %s", e)
             return f"Error: {str(e)}"
     
+    def get_emails_metadata(self, message_ids: List[str], metadata_headers: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Fetch metadata for many emails using batched requests (one round trip per 100 IDs)"""
+        fetched = {}
+        failed = []
+        
+        def on_response(request_id, response, exception):
+            if exception is None:
+                fetched[request_id] = response
+            elif "404" in str(exception) or "not found" in str(exception).lower():
+                return  # Silently skip deleted emails
+            else:
+                failed.append(request_id)  # Retried below without the batch endpoint
+        
+        for start in range(0, len(message_ids), GMAIL_BATCH_LIMIT):
+            chunk = message_ids[start:start + GMAIL_BATCH_LIMIT]
+            batch = self.api_resource.new_batch_http_request(callback=on_response)
+            for msg_id in chunk:
+                batch.add(
+                    self.api_resource.users().messages().get(
+                        userId='me',
+                        id=msg_id,
+                        format='metadata',
+                        metadataHeaders=metadata_headers
+                    ),
+                    request_id=msg_id
+                )
+            try:
+                batch.execute(http=self._http())
+            except HttpError as e:
+                logger.warning("  ⚠ Batch request failed (%s), fetching individually...", e.resp.status)
+                failed.extend(msg_id for msg_id in chunk if msg_id not in fetched)
+        
+        if failed:
+            fetched.update(self.fetch_emails_concurrently(failed, format='metadata', metadataHeaders=metadata_headers))
+        
+        return fetched
+    
+    def fetch_emails_concurrently(self, message_ids: List[str], **params: Any) -> Dict[str, Dict[str, Any]]:
+        """Fetch emails with concurrent GET requests on the shared client (fallback when batching fails)"""
+        async def fetch_all():
+            semaphore = asyncio.Semaphore(FALLBACK_CONCURRENCY)
+            
+            async def fetch_one(msg_id):
+                async with semaphore:
+                    try:
+                        return msg_id, await self._gmail_get_async(f"/messages/{msg_id}", params)
+                    except httpx.HTTPStatusError as e:
+                        if e.response.status_code != 404:  # Silently skip deleted emails
+                            logger.warning("  ⚠ Error fetching email %s...: %s", msg_id[:8], e)
+                    except httpx.HTTPError as e:
+                        logger.warning("  ⚠ Error fetching email %s...: %s", msg_id[:8], e)
+                    return msg_id, None
+            
+            return await asyncio.gather(*[fetch_one(msg_id) for msg_id in message_ids])
+        
+        return {msg_id: data for msg_id, data in self._run(fetch_all()) if data}
+    
     def search_new_emails(self, max_results: Optional[int] = None, after_message_id: Optional[str] = None) -> List[Dict[str, Any]]:
         """Get new unread emails from primary tab (skip already processed!)"""
-        print(f"🔍 Searching new emails...")
+        logger.info("🔍 Searching new emails...")
         
         try:
             # Build Gmail search query
@@ -113,92 +878,87 @@ class EmailAgent:
             # Fetch with appropriate limit
             fetch_limit = max_results if max_results else 50
             
-            results = self.api_resource.users().messages().list(
-                userId='me',
-                q=query,
-                maxResults=fetch_limit
-            ).execute()
+            results = self._gmail_get("/messages", {"q": query, "maxResults": fetch_limit})
             
             messages = results.get('messages', [])
             if not messages:
-                print(f"✓ Found 0 new email(s)")
+                logger.info("✓ Found 0 new email(s)")
                 return []
             
-            # Process emails, skipping already processed ones
-            for msg in messages:
-                msg_id = msg['id']
-                
-                # Skip if already processed (using our Set tracker)
-                if msg_id in self.processed_emails:
-                    continue
-                
-                # Get email headers
-                msg_data = self.api_resource.users().messages().get(
-                    userId='me',
-                    id=msg_id,
-                    format='metadata',
-                    metadataHeaders=['From', 'Subject', 'Date']
-                ).execute()
-                
-                headers = msg_data.get('payload', {}).get('headers', [])
-                sender = next((h['value'] for h in headers if h['name'].lower() == 'from'), 'Unknown')
-                subject = next((h['value'] for h in headers if h['name'].lower() == 'subject'), 'No Subject')
-                date = next((h['value'] for h in headers if h['name'].lower() == 'date'), 'Unknown')
-                
-                internal_date = int(msg_data.get('internalDate', 0))
-                
-                all_emails.append({
-                    'id': msg_id,
-                    'sender': sender,
-                    'subject': subject,
-                    'date': date,
-                    'internal_date': internal_date
-                })
-                
-                # Check max results
-                if max_results and len(all_emails) >= max_results:
-                    break
+            # Skip already processed emails
+            msg_ids = [msg['id'] for msg in messages if not self.is_processed(msg['id'])]
+            if max_results:
+                msg_ids = msg_ids[:max_results]
             
-            print(f"✓ Found {len(all_emails)} new email(s)")
+            # Get email headers in a single batched round trip
+            metadata = self.get_emails_metadata(msg_ids, ['From', 'Subject', 'Date', 'List-Unsubscribe'])
+            
+            for msg_id in msg_ids:
+                msg_data = metadata.get(msg_id)
+                if msg_data:
+                    all_emails.append(_email_summary(msg_id, msg_data))
+            
+            logger.info("✓ Found %s new email(s)", len(all_emails))
             return all_emails
             
         except Exception as e:
-            print(f"⚠ Error searching emails: {str(e)}")
+            logger.warning("⚠ Error searching emails: %s", e)
             return []
     
-    def get_email_details(self, message_id: str) -> Dict[str, Any]:
-        """Get full email content"""
+    def get_history_id(self) -> str:
+        """Get the mailbox's current historyId (starting point for incremental sync)"""
+        return self._gmail_get("/profile")['historyId']
+    
+    def search_history_changes(self) -> Tuple[List[Dict[str, Any]], str]:
+        """Get unread primary emails added since the historyId checkpoint, plus the historyId to resume from (raises a 404 HTTPStatusError once it expires)"""
+        new_ids = []
+        history_id = self.history_id
+        params = {
+            "startHistoryId": self.history_id,
+            "historyTypes": "messageAdded",
+            "labelId": "INBOX",
+        }
+        while True:
+            results = self._gmail_get("/history", params)
+            for record in results.get('history', []):
+                for added in record.get('messagesAdded', []):
+                    message = added['message']
+                    labels = message.get('labelIds', [])
+                    # Same selection as 'is:unread category:primary'
+                    if 'UNREAD' not in labels or any(label in NON_PRIMARY_CATEGORY_LABELS for label in labels):
+                        continue
+                    if message['id'] not in new_ids and not self.is_processed(message['id']):
+                        new_ids.append(message['id'])
+            history_id = results.get('historyId', history_id)
+            if not results.get('nextPageToken'):
+                break
+            params["pageToken"] = results['nextPageToken']
+        
+        if not new_ids:
+            return [], history_id
+        
+        metadata = self.get_emails_metadata(new_ids, ['From', 'Subject', 'Date', 'List-Unsubscribe'])
+        return [_email_summary(msg_id, metadata[msg_id]) for msg_id in new_ids if msg_id in metadata], history_id
+    
+    def get_email_details(self, message_id: str, max_decode_bytes: int = 8192) -> Dict[str, Any]:
+        """Get full email content (only the first max_decode_bytes of the body are decoded)"""
         try:
-            msg = self.api_resource.users().messages().get(
-                userId='me',
-                id=message_id,
-                format='full'
-            ).execute()
+            msg = self._gmail_get(f"/messages/{message_id}", {"format": "full"})
             
             # Extract headers
-            headers = msg.get('payload', {}).get('headers', [])
-            sender = next((h['value'] for h in headers if h['name'].lower() == 'from'), 'Unknown')
-            to = next((h['value'] for h in headers if h['name'].lower() == 'to'), 'Unknown')
-            subject = next((h['value'] for h in headers if h['name'].lower() == 'subject'), 'No Subject')
-            date = next((h['value'] for h in headers if h['name'].lower() == 'date'), 'Unknown')
-            
-            # Extract body
-            body = ""
-            payload = msg.get('payload', {})
+            headers = _headers_dict(msg.get('payload', {}))
+            sender = headers.get('from', 'Unknown')
+            to = headers.get('to', 'Unknown')
+            subject = headers.get('subject', 'No Subject')
+            date = headers.get('date', 'Unknown')
             
-            if 'parts' in payload:
-                for part in payload['parts']:
-                    if part.get('mimeType') == 'text/plain':
-                        body_data = part.get('body', {}).get('data', '')
-                        if body_data:
-                            import base64
-                            body = base64.urlsafe_b64decode(body_data).decode('utf-8', errors='ignore')
-                            break
-            elif 'body' in payload:
-                body_data = payload['body'].get('data', '')
-                if body_data:
-                    import base64
-                    body = base64.urlsafe_b64decode(body_data).decode('utf-8', errors='ignore')
+            # Extract body (first text/plain part at any depth)
+            payload = msg.get('payload', {})
+            body_part = next(_walk_parts(payload), None)
+            if body_part is None and 'parts' not in payload:
+                # Single-part emails keep their body whatever the mime type
+                body_part = payload.get('body', {})
+            body = _decode_body(body_part, max_decode_bytes) if body_part else ""
             
             # Limit body length
             if len(body) > 2000:
@@ -211,11 +971,13 @@ class EmailAgent:
                 "subject": subject,
                 "date": date,
                 "body": body or "No body content",
-                "snippet": msg.get('snippet', '')
+                "snippet": msg.get('snippet', ''),
+                "list_unsubscribe": headers.get('list-unsubscribe', ''),
+                "label_ids": msg.get('labelIds', [])
             }
             
         except Exception as e:
-            print(f"⚠ Error fetching email: {e}")
+            logger.warning("⚠ Error fetching email: %s", e)
             return {
                 "id": message_id,
                 "from": "Unknown",
@@ -228,101 +990,103 @@ class EmailAgent:
     
     
     def search_conversation_history(self, sender_email: str) -> Dict[str, Any]:
-        """Get COMPLETE conversation history (both incoming AND sent emails)"""
-        email_match = re.search(r'[\w\.-]+@[\w\.-]+', sender_email)
+        """Get COMPLETE conversation history (both incoming AND sent emails), cached per sender"""
+        email_match = _EMAIL_RE.search(sender_email)
         if email_match:
             sender_email = email_match.group(0)
+        cache_key = sender_email.lower()
         
-        print(f"  🔍 Getting FULL conversation history with {sender_email}...")
-        
-        try:
-            all_emails = []
-            
-            # Search for ALL emails with this person (both from them AND to them)
-            # This includes your sent replies!
-            query = f'({sender_email})'
-            
-            results = self.api_resource.users().messages().list(
-                userId='me',
-                q=query,
-                maxResults=20  # Get last 20 emails in conversation
-            ).execute()
+        with self._history_lock:
+            sender_lock = self._history_locks[cache_key]
+        # Prefetch threads asking for the same sender wait for the first fetch
+        with sender_lock:
+            cached = self._history_cache.get(cache_key)
+            if cached and time.time() - cached[0] < HISTORY_CACHE_TTL:
+                return cached[1]
             
-            messages = results.get('messages', [])
-            if not messages:
-                print(f"  ✓ No conversation history found")
+            # Runs on prefetch threads: progress is logged by the caller with its own email
+            try:
+                history = self._fetch_conversation_history(sender_email)
+            except Exception as e:
+                # Errors are not cached so the next email retries
+                logger.warning("  ⚠ Error searching history: %s", e)
                 return {
                     'total_count': 0,
                     'sender': sender_email,
                     'all_emails': [],
-                    'summary': f"No previous conversation with {sender_email}"
+                    'summary': f"Error searching history: {str(e)}"
                 }
-            
-            # Get email details
-            for msg in messages:
-                msg_id = msg['id']
-                try:
-                    msg_data = self.api_resource.users().messages().get(
-                        userId='me',
-                        id=msg_id,
-                        format='metadata',
-                        metadataHeaders=['From', 'To', 'Subject', 'Date']
-                    ).execute()
-                    
-                    headers = msg_data.get('payload', {}).get('headers', [])
-                    from_addr = next((h['value'] for h in headers if h['name'].lower() == 'from'), 'Unknown')
-                    to_addr = next((h['value'] for h in headers if h['name'].lower() == 'to'), 'Unknown')
-                    subject = next((h['value'] for h in headers if h['name'].lower() == 'subject'), 'No Subject')
-                    date = next((h['value'] for h in headers if h['name'].lower() == 'date'), 'Unknown')
-                    snippet = msg_data.get('snippet', '')
-                    
-                    # Determine if this is incoming or sent
-                    direction = "FROM them" if sender_email.lower() in from_addr.lower() else "TO them (your reply)"
-                    
-                    all_emails.append({
-                        'id': msg_id,
-                        'from': from_addr,
-                        'to': to_addr,
-                        'subject': subject,
-                        'date': date,
-                        'snippet': snippet,
-                        'direction': direction
-                    })
-                except Exception as e:
-                    # Skip emails that were deleted/moved (404 errors)
-                    if "404" in str(e) or "not found" in str(e).lower():
-                        continue  # Silently skip deleted emails
-                    else:
-                        print(f"  ⚠ Error fetching email {msg_id[:8]}...: {str(e)}")
-                        continue
-            
-            # Create summary with DIRECTION indicators
-            print(f"  ✓ Found {len(all_emails)} emails (incoming + sent)")
-            
-            summary = f"COMPLETE conversation history with {sender_email}:\\n\\n"
-            summary += f"Last 20 Emails (both directions):\\n" + "=" * 50 + "\\n\\n"
-            
-            for idx, email in enumerate(all_emails, 1):
-                summary += f"{idx}. [{email['direction']}]\\n"
-                summary += f"   Subject: {email['subject']}\\n"
-                summary += f"   Date: {email['date']}\\n"
-                summary += f"   Preview: {email['snippet'][:100]}...\\n\\n"
-            
-            return {
-                'total_count': len(all_emails),
-                'sender': sender_email,
-                'all_emails': all_emails,
-                'summary': summary
-            }
-            
-        except Exception as e:
-            print(f"  ⚠ Error searching history: {e}")
+            self._history_cache[cache_key] = (time.time(), history)
+            return history
+    
+    def _fetch_conversation_history(self, sender_email: str) -> Dict[str, Any]:
+        """List the last 20 emails with sender_email and build the history summary"""
+        all_emails = []
+        
+        # Search for ALL emails with this person (both from them AND to them)
+        # This includes your sent replies!
+        query = f'({sender_email})'
+        
+        results = self._gmail_get("/messages", {
+            "q": query,
+            "maxResults": 20  # Get last 20 emails in conversation
+        })
+        
+        messages = results.get('messages', [])
+        if not messages:
             return {
                 'total_count': 0,
                 'sender': sender_email,
                 'all_emails': [],
-                'summary': f"Error searching history: {str(e)}"
+                'summary': f"No previous conversation with {sender_email}"
             }
+        
+        # Get email details in one batched round trip
+        # (emails that were deleted/moved are skipped by the batch callback)
+        msg_ids = [msg['id'] for msg in messages]
+        metadata = self.get_emails_metadata(msg_ids, ['From', 'To', 'Subject', 'Date'])
+        
+        for msg_id in msg_ids:
+            msg_data = metadata.get(msg_id)
+            if not msg_data:
+                continue
+            
+            headers = _headers_dict(msg_data.get('payload', {}))
+            from_addr = headers.get('from', 'Unknown')
+            to_addr = headers.get('to', 'Unknown')
+            subject = headers.get('subject', 'No Subject')
+            date = headers.get('date', 'Unknown')
+            snippet = msg_data.get('snippet', '')
+            
+            # Determine if this is incoming or sent
+            direction = "FROM them" if sender_email.lower() in from_addr.lower() else "TO them (your reply)"
+            
+            all_emails.append({
+                'id': msg_id,
+                'from': from_addr,
+                'to': to_addr,
+                'subject': subject,
+                'date': date,
+                'snippet': snippet,
+                'direction': direction
+            })
+        
+        # Create summary with DIRECTION indicators
+        summary = f"COMPLETE conversation history with {sender_email}:\\n\\n"
+        summary += f"Last 20 Emails (both directions):\\n" + "=" * 50 + "\\n\\n"
+        
+        for idx, email in enumerate(all_emails, 1):
+            summary += f"{idx}. [{email['direction']}]\\n"
+            summary += f"   Subject: {email['subject']}\\n"
+            summary += f"   Date: {email['date']}\\n"
+            summary += f"   Preview: {email['snippet'][:100]}...\\n\\n"
+        
+        return {
+            'total_count': len(all_emails),
+            'sender': sender_email,
+            'all_emails': all_emails,
+            'summary': summary
+        }
     
     def generate_response_with_context(self, new_email: Dict[str, Any], conversation_history: Dict[str, Any]) -> str:
         """Generate response using email content and conversation history"""
@@ -355,10 +1119,26 @@ Create a thoughtful, professional response that:
 
 Write only the response body (no subject needed)."""
         
-        print(f"  🤖 Generating response (considering {total_emails} past emails)...")
+        logger.info("  🤖 Generating response (considering %s past emails)...", total_emails)
         response = self.run_agent_task(query)
         return response
     
+    def lookup_cached_classification(self, email: Dict[str, Any]) -> Tuple[Optional[np.ndarray], Optional[str]]:
+        """Embed an email's salient features and look up the label of a near-duplicate (None, None on errors)"""
+        sender = email.get('from', '')
+        subject = email.get('subject', '')
+        body = email.get('body', '')
+        snippet = body[:500] if body else email.get('snippet', '')[:500]
+        
+        sender_domain = sender.split('@')[-1].strip('<> ').lower()
+        try:
+            cache_vector = classification_cache.embed(f"{sender_domain}|{subject}|{snippet}")
+            return cache_vector, classification_cache.lookup(self.mailbox, cache_vector)
+        except Exception as e:
+            # A broken cache (e.g. embeddings.db locked by another process) is just a miss
+            logger.warning("  ⚠ Classification cache unavailable: %s", e)
+            return None, None
+    
     def classify_email(self, email: Dict[str, Any]) -> str:
         """Classify email using memory-augmented learning"""
         # Extract metadata
@@ -367,6 +1147,15 @@ Write only the response body (no subject needed)."""
         body = email.get('body', '')
         snippet = body[:500] if body else email.get('snippet', '')[:500]
         
+        # Bulk mail (no-reply senders, List-Unsubscribe, Promotions/Social tabs) never reaches the LLM
+        if _prefilter_ignore(email):
+            return "ignore"
+        
+        # Near-duplicate emails (newsletters, notification templates) reuse a cached label
+        cache_vector, cached_action = self.lookup_cached_classification(email)
+        if cached_action:
+            return cached_action
+        
         # Memory-augmented classification prompt
         classification_prompt = f"""You are a smart email classifier with long-term memory.
 Based on the sender, subject, and content, decide if this email should be:
@@ -375,24 +1164,7 @@ Based on the sender, subject, and content, decide if this email should be:
 
 Return only one word: "ignore" or "process".
 
-**Ignore** emails that are:
-* Promotional or marketing (sales, offers, discounts, newsletters)
-* Automated system emails (confirmations, subscriptions, security alerts)
-* Social notifications (LinkedIn, Instagram, YouTube, etc.)
-* Event updates, ticket bookings, or receipts
-* Recruitment spam, newsletters, or general HR ads
-* Mails without a personal greeting or request for action
-* Gaming promotions, rewards, or virtual currency offers
-* No-reply senders with marketing content
-
-**Process** emails that are:
-* From known colleagues, professors, or managers
-* Contain questions, requests, or project details
-* Related to academic or professional tasks
-* Require replies, reports, scheduling, or document review
-* Have "urgent", "follow-up", or "update" in subject
-* Personal correspondence with specific requests
-
+{CLASSIFICATION_RULES}
 EMAIL DETAILS:
 From: {sender}
 Subject: {subject}
@@ -401,11 +1173,64 @@ Snippet: {snippet}
         
         action = self.run_agent_task(classification_prompt).strip().lower()
         
+        # Only cache clean labels (never errors or rambling answers)
+        if action in CLASSIFICATION_LABELS and cache_vector is not None:
+            classification_cache.add(self.mailbox, cache_vector, action)
+        
         # Memory learning happens automatically via the agent's memory store
         # No need to explicitly call memory tools - they work in the background
         
         return action
     
+    def classify_and_maybe_draft(self, email: Dict[str, Any], history_summary: str) -> Dict[str, str]:
+        """Classify email and draft the reply in a single JSON-mode LLM call"""
+        sender = email.get('from', '')
+        subject = email.get('subject', '')
+        body = email.get('body', '')
+        
+        if _prefilter_ignore(email):
+            return {"action": "ignore", "draft": ""}
+        
+        cache_vector, cached_action = self.lookup_cached_classification(email)
+        if cached_action == "ignore":
+            return {"action": "ignore", "draft": ""}
+        
+        # Limit history to avoid token issues
+        if len(history_summary) > 1500:
+            history_summary = history_summary[:1500] + "...[truncated]"
+        
+        fused_prompt = f"""You are a smart email assistant.
+Decide if this email should be ignored or processed, and if processed, draft a reply.
+
+{CLASSIFICATION_RULES}
+EMAIL DETAILS:
+From: {sender}
+Subject: {subject}
+Body: {body}
+
+CONVERSATION HISTORY:
+{history_summary}
+
+Respond with a JSON object: {{"action": "ignore" or "process", "draft": "..."}}
+"draft" is a thoughtful, professional, clear and concise reply body (no subject) that
+addresses the main points and considers our conversation history.
+Leave "draft" empty when the action is "ignore"."""
+        
+        try:
+            response = self.json_llm.invoke(fused_prompt)
+            result = json.loads(response.content)
+        except Exception as e:
+            logger.warning("  ⚠ Combined classify/draft failed: %s", e)
+            return {"action": "", "draft": ""}
+        
+        action = str(result.get("action", "")).strip().lower()
+        draft = str(result.get("draft") or "").strip()
+        
+        if action in CLASSIFICATION_LABELS and cache_vector is not None:
+            classification_cache.add(self.mailbox, cache_vector, action)
+        
+        return {"action": action, "draft": draft}
+    
     def create_draft_reply(self, original_email: Dict[str, Any], response_body: str) -> bool:
         """Create draft email response"""
         sender = original_email.get('from', '')
@@ -423,7 +1248,7 @@ CREATE A DRAFT with these details:
 
 Call the gmail_create_draft tool NOW and confirm success."""
         
-        print(f"  ✉️ Creating draft...")
+        logger.info("  ✉️ Creating draft...")
         response = self.run_agent_task(query)
         
         # More comprehensive success detection
@@ -434,138 +1259,216 @@ Call the gmail_create_draft tool NOW and confirm success."""
         ]
         
         if any(indicator in response.lower() for indicator in success_indicators):
-            print(f"  ✓ Draft created in Gmail!")
+            logger.info("  ✓ Draft created in Gmail!")
             return True
         else:
             # If unclear, assume it worked (agent tools usually succeed)
-            print(f"  ✓ Draft created (agent executed)")
+            logger.info("  ✓ Draft created (agent executed)")
             return True
     
     def process_new_emails(self):
-        """Main process: Check and process new emails using timestamp filter"""
-        print("\n" + "=" * 50)
-        print("CHECKING NEW EMAILS...")
-        print("=" * 50 + "\n")
+        """Main process: Check and process new emails (historyId sync, timestamp filter fallback)"""
+        try:
+            self._process_new_emails()
+        finally:
+            # Buffered log lines are written once per sweep
+            log_handler.flush()
+    
+    def _process_new_emails(self):
+        """One sweep of process_new_emails (log output is buffered until it returns)"""
+        logger.info("\n%s", "=" * 50)
+        logger.info("CHECKING NEW EMAILS...")
+        logger.info("%s\n", "=" * 50)
+        
+        # Conversation history is shared only between emails of the same sweep
+        with self._history_lock:
+            self._history_cache.clear()
+            self._history_locks.clear()
         
         # FIRST RUN: Process last 5 unread, set checkpoint
         if not self.last_check_time:
-            print("FIRST RUN: Getting last 5 unread emails...")
+            logger.info("FIRST RUN: Getting last 5 unread emails...")
+            try:
+                # Taken before listing so nothing arriving meanwhile is missed
+                history_id = self.get_history_id()
+            except Exception as e:
+                logger.warning("Error: %s", e)
+                return
             emails = self.search_new_emails(max_results=5)
             
             if not emails:
-                print("No unread emails found.")
+                logger.info("No unread emails found.")
                 self.last_check_time = int(time.time() * 1000)
+                self.history_id = history_id
                 return
             
             # Set checkpoint to newest email timestamp
             self.last_check_time = emails[0]['internal_date']
-            print(f"Checkpoint set: {self.last_check_time}")
+            logger.info("Checkpoint set: %s", self.last_check_time)
+        elif self.history_id:
+            # LIVE MODE: Only ask Gmail for changes since the last historyId
+            logger.info("LIVE MODE: Checking for new arrivals...")
+            logger.info("History checkpoint: %s", self.history_id)
+            
+            try:
+                emails, history_id = self.search_history_changes()
+                logger.info("Found %s new emails", len(emails))
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code != 404:
+                    logger.warning("Error: %s", e)
+                    return
+                # History is only kept for about a week; resync with a full scan
+                logger.info("History checkpoint expired, falling back to full scan...")
+                self.history_id = None
+                return self._process_new_emails()
+            except Exception as e:
+                logger.warning("Error: %s", e)
+                return
         else:
             # LIVE MODE: Get ALL unread, filter by timestamp
-            print("LIVE MODE: Checking for new arrivals...")
-            print(f"Checkpoint: {self.last_check_time}")
+            logger.info("LIVE MODE: Checking for new arrivals...")
+            logger.info("Checkpoint: %s", self.last_check_time)
             
             try:
-                results = self.api_resource.users().messages().list(
-                    userId='me',
-                    q='is:unread category:primary',
-                    maxResults=10  # Reasonable limit - unlikely to get 20 emails in 60 sec
-                ).execute()
+                # Resume incremental sync from here once this scan succeeds
+                history_id = self.get_history_id()
+                results = self._gmail_get("/messages", {
+                    "q": 'is:unread category:primary',
+                    "maxResults": 10  # Reasonable limit - unlikely to get 20 emails in 60 sec
+                })
                 
                 messages = results.get('messages', [])
-                print(f"Scanning {len(messages)} unread emails...")
+                logger.info("Scanning %s unread emails...", len(messages))
                 emails = []
                 
+                # Fetch all headers in one batched round trip
+                metadata = self.get_emails_metadata([msg['id'] for msg in messages], ['From', 'Subject', 'Date', 'List-Unsubscribe'])
+                
                 for idx, msg in enumerate(messages, 1):
-                    msg_data = self.api_resource.users().messages().get(
-                        userId='me',
-                        id=msg['id'],
-                        format='metadata',
-                        metadataHeaders=['From', 'Subject', 'Date']
-                    ).execute()
+                    msg_data = metadata.get(msg['id'])
+                    if not msg_data:
+                        continue
                     
                     internal_date = int(msg_data.get('internalDate', 0))
                     
                     # Stop if we hit an email older than checkpoint (emails are sorted newest first)
                     if internal_date <= self.last_check_time:
-                        print(f"Reached checkpoint at email {idx}/{len(messages)}")
+                        logger.info("Reached checkpoint at email %s/%s", idx, len(messages))
                         break
                     
                     # This email is NEW!
-                    headers = msg_data.get('payload', {}).get('headers', [])
-                    emails.append({
-                        'id': msg['id'],
-                        'sender': next((h['value'] for h in headers if h['name'].lower() == 'from'), 'Unknown'),
-                        'subject': next((h['value'] for h in headers if h['name'].lower() == 'subject'), 'No Subject'),
-                            'date': next((h['value'] for h in headers if h['name'].lower() == 'date'), 'Unknown'),
-                            'internal_date': internal_date
-                        })
+                    emails.append(_email_summary(msg['id'], msg_data))
                 
-                print(f"Found {len(emails)} new emails")
+                logger.info("Found %s new emails", len(emails))
             except Exception as e:
-                print(f"Error: {e}")
+                logger.warning("Error: %s", e)
                 return
         
         if not emails:
-            print("No new emails found.")
+            logger.info("No new emails found.")
+            self.history_id = history_id
             return
         
-        print(f"\nProcessing {len(emails)} NEW emails...\n")
+        logger.info("\nProcessing %s NEW emails...\n", len(emails))
         
-        # Process each email
-        for idx, email_info in enumerate(emails, 1):
+        # Gmail fetches for the next email run in the background while the
+        # current one waits on the LLM
+        executor = ThreadPoolExecutor(max_workers=2)
+        prefetched = {}
+        
+        def prefetch(email_info):
             message_id = email_info.get('id')
-            if not message_id:
-                continue
+            if (message_id and message_id not in prefetched
+                    and not self.is_processed(message_id) and not _prefilter_ignore(email_info)):
+                prefetched[message_id] = (
+                    executor.submit(self.get_email_details, message_id),
+                    executor.submit(self.search_conversation_history, email_info.get('sender', '')),
+                )
+        
+        try:
+            prefetch(emails[0])
+            
+            # Memories written during the sweep are embedded together at the end
+            with store.deferred_embeddings():
+                # Process each email
+                for idx, email_info in enumerate(emails, 1):
+                    message_id = email_info.get('id')
+                    if not message_id or self.is_processed(message_id):
+                        continue
+                    
+                    # Metadata is enough to ignore bulk mail: skip downloading the body
+                    if _prefilter_ignore(email_info):
+                        logger.info("\nEMAIL %s/%s: ignoring bulk mail from %s", idx, len(emails), email_info.get('sender', 'Unknown'))
+                        self.mark_processed(message_id, email_info.get('internal_date'))
+                        continue
+                
+                    prefetch(email_info)  # No-op unless the previous email was skipped
+                    details_future, history_future = prefetched.pop(message_id)
+                    if idx < len(emails):
+                        prefetch(emails[idx])
 
-            print(f"\n{'─' * 50}")
-            print(f"EMAIL {idx}/{len(emails)}")
-            print(f"{'─' * 50}\n")
-
-            # Get email details
-            print("1. Fetching email...")
-            new_email = self.get_email_details(message_id)
-            print(f"  From: {new_email.get('from', 'Unknown')}")
-            print(f"  Subject: {new_email.get('subject', 'No subject')}")
-
-            # Classify email using memory-learning
-            print("2. Classifying email...")
-            time.sleep(1)  # Rate limit protection
-            action = self.classify_email(new_email)
-            print(f"  Classification: {action}")
-
-            if "ignore" in action.lower():
-                print("  Ignoring email.")
-                self.processed_emails.add(message_id)
-                continue
+                    logger.info("\n%s", '─' * 50)
+                    logger.info("EMAIL %s/%s", idx, len(emails))
+                    logger.info("%s\n", '─' * 50)
 
-            # Get conversation history
-            print("3. Getting conversation history...")
-            history = self.search_conversation_history(new_email.get('from', ''))
+                    # Get email details
+                    logger.info("1. Fetching email...")
+                    new_email = details_future.result()
+                    logger.info("  From: %s", new_email.get('from', 'Unknown'))
+                    logger.info("  Subject: %s", new_email.get('subject', 'No subject'))
 
-            # Generate response
-            print("4. Generating response...")
-            time.sleep(2)  # Rate limit protection
-            response = self.generate_response_with_context(new_email, history)
+                    # Short personal emails: classify and draft in a single LLM call
+                    fused = {"action": "", "draft": ""}
+                    body = new_email.get('body', '')
+                    if len(body) < FUSED_MAX_BODY_CHARS and not _looks_automated(new_email.get('from', '')):
+                        logger.info("2. Classifying + drafting (single call)...")
+                        fused = self.classify_and_maybe_draft(new_email, history_future.result().get('summary', ''))
+                
+                    action = fused['action']
+                    if action not in CLASSIFICATION_LABELS:
+                        # Classify email using memory-learning
+                        logger.info("2. Classifying email...")
+                        action = self.classify_email(new_email)
+                    logger.info("  Classification: %s", action)
 
-            # Create draft
-            print("5. Creating draft...")
-            time.sleep(1)  # Rate limit protection
-            self.create_draft_reply(new_email, response)
+                    if "ignore" in action.lower():
+                        logger.info("  Ignoring email.")
+                        self.mark_processed(message_id, email_info.get('internal_date'))
+                        continue
 
-            self.processed_emails.add(message_id)
-            print(f"\nEMAIL {idx} PROCESSED!")
-            
-            # Rate limit between emails
-            if idx < len(emails):
-                time.sleep(2)
+                    # Get conversation history
+                    logger.info("3. Getting conversation history...")
+                    history = history_future.result()
+                    logger.info("  🔍 Getting FULL conversation history with %s...", history['sender'])
+                    logger.info("  ✓ Found %s emails (incoming + sent)", history['total_count'])
+
+                    # Generate response (unless the combined call already drafted one)
+                    logger.info("4. Generating response...")
+                    if fused['draft']:
+                        logger.info("  ✓ Using draft from classification call")
+                        response = fused['draft']
+                    else:
+                        response = self.generate_response_with_context(new_email, history)
+
+                    # Create draft
+                    logger.info("5. Creating draft...")
+                    self.create_draft_reply(new_email, response)
+
+                    self.mark_processed(message_id, email_info.get('internal_date'))
+                    logger.info("\nEMAIL %s PROCESSED!", idx)
+        finally:
+            # Drop queued prefetches even when processing fails partway
+            executor.shutdown(wait=False, cancel_futures=True)
+        
+        # Resume incremental sync from here only once every email was handled
+        self.history_id = history_id
         
         # Update checkpoint to the NEWEST email timestamp
         if emails:
             # Find the newest timestamp
             newest_timestamp = max(email['internal_date'] for email in emails)
             self.last_check_time = newest_timestamp
-            print(f"\nCheckpoint updated: {newest_timestamp}")
+            logger.info("\nCheckpoint updated: %s", newest_timestamp)
     
     def run_continuous(self, check_interval: int = 60):
         """Run continuously, checking for new emails"""